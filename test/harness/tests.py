@@ -6,6 +6,7 @@ import sys
 import os
 import unittest
 import time
+import tempfile
 
 from . import util
 from .util import Global
@@ -40,6 +41,16 @@ def print_time_values():
     util.vprint('Total test-run time: %s' % (s2dt(Global.total_time)))
 
 
+def setUpModule():
+    # one mount point for the whole test run
+    Global.mountpoint = tempfile.mkdtemp(prefix='open-iscsi-test-')
+
+
+def tearDownModule():
+    os.rmdir(Global.mountpoint)
+    Global.mountpoint = None
+
+
 class TestRegression(unittest.TestCase):
     """
     Regression testing
@@ -47,7 +58,11 @@ class TestRegression(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        util.verify_needed_commands_exist(['parted', 'fio', Global.MKFSCMD[0], 'bonnie++', 'sgdisk', 'iscsiadm'])
+        needed_cmds = ['fio', Global.MKFSCMD[0], 'bonnie++', 'iscsiadm']
+        if util.parted is None:
+            # no libparted, so we partition using the commands
+            needed_cmds += ['parted', 'sgdisk']
+        util.verify_needed_commands_exist(needed_cmds)
         util.vprint('*** Starting %s' % cls.__name__)
         # XXX validate that target exists?
         # an array of first burts, max burst, and max recv values, for testing
@@ -9,6 +9,18 @@ import unittest
 import time
 import tempfile
 import re
+import functools
+import json
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+try:
+    import parted
+except ImportError:
+    parted = None
 
 from . import __version__ as lib_version
 
@@ -16,16 +28,11 @@ from . import __version__ as lib_version
 # globals
 #
 class Global:
-    FSTYPE = os.getenv('FSTYPE', 'ext3')
-    if os.getenv('MOUNTOPTIONS'):
-        MOUNTOPTIONS = os.getenv('MOUNTOPTIONS').split(' ')
-    else:
-        MOUNTOPTIONS = []
-    MOUNTOPTIONS += ['-t', FSTYPE]
-    MKFSCMD = [os.getenv('MKFSCMD', 'mkfs.' + FSTYPE)]
-    if os.getenv('MKFSOPTS'):
-        MKFSCMD += os.getenv('MKFSOPTS').split(' ')
-    BONNIEPARAMS = os.getenv('BONNIEPARAMS', '-r0 -n10:0:0 -s16 -uroot -f -q').split(' ')
+    # these come from the environment -- see _init_globals()
+    FSTYPE = None
+    MOUNTOPTIONS = []
+    MKFSCMD = []
+    BONNIEPARAMS = []
     verbosity = 1
     debug = False
     # the target (e.g. "iqn.*")
@@ -36,6 +43,8 @@ class Global:
     device = None
     # the first and only partition on said device
     partition = None
+    # where the filesystem gets mounted for bonnie++
+    mountpoint = None
     # optional override for fio disk testing block size(s)
     blocksize = None
     # subtests to run -- by default, all of them
@@ -43,41 +52,64 @@ class Global:
     # no good way to detect that.
     subtest_list = [i+1 for i in range(16)]
     # for timing
-    timing = dict.fromkeys(['fio', 'sgdisk', 'dd', 'bonnie', 'mkfs', 'sleep'], 0.0)
+    timing = dict.fromkeys(['fio', 'sgdisk', 'libparted', 'dd', 'bonnie', 'mkfs', 'sleep'], 0.0)
     total_time = 0.0
 
 
+def _init_globals():
+    """
+    Fill in the globals that come from the environment -- done at
+    startup rather than at import time, so it can be redone if the
+    environment changes
+    """
+    Global.FSTYPE = os.getenv('FSTYPE', 'ext3')
+    if os.getenv('MOUNTOPTIONS'):
+        Global.MOUNTOPTIONS = os.getenv('MOUNTOPTIONS').split(' ')
+    else:
+        Global.MOUNTOPTIONS = []
+    Global.MOUNTOPTIONS += ['-t', Global.FSTYPE]
+    Global.MKFSCMD = [os.getenv('MKFSCMD', 'mkfs.' + Global.FSTYPE)]
+    if os.getenv('MKFSOPTS'):
+        Global.MKFSCMD += os.getenv('MKFSOPTS').split(' ')
+    Global.BONNIEPARAMS = os.getenv('BONNIEPARAMS', '-r0 -n10:0:0 -s16 -uroot -f -q').split(' ')
+
 def dprint(*args):
     """
     Print a debug message if in debug mode
     """
     if Global.debug:
-        print('DEBUG: ', file=sys.stderr, end='')
-        for arg in args:
-            print(arg, file=sys.stderr, end='')
-        print('', file=sys.stderr)
+        sys.stderr.write('DEBUG: ' + ''.join(str(arg) for arg in args) + '\n')
 
 def vprint(*args):
     """
     Print a verbose message
     """
     if Global.verbosity > 1 and args:
-        for arg in args:
-            print(arg, end='')
-        print('')
+        sys.stdout.write(''.join(str(arg) for arg in args) + '\n')
 
-def run_cmd(cmd, output_save_file=None):
+def _spawn_cmd(cmd, output_save_file=None):
     """
-    run specified command, waiting for and returning result
+    start specified command using posix_spawnp(), which does not have
+    to copy our page tables the way fork() does, returning its pid
+    """
+    file_actions = []
+    if output_save_file:
+        file_actions.append((os.POSIX_SPAWN_OPEN, 1, output_save_file,
+                             os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o664))
+        file_actions.append((os.POSIX_SPAWN_DUP2, 1, 2))
+    elif not Global.debug:
+        file_actions.append((os.POSIX_SPAWN_OPEN, 1, '/dev/null', os.O_WRONLY, 0))
+        file_actions.append((os.POSIX_SPAWN_DUP2, 1, 2))
+    return os.posix_spawnp(cmd[0], cmd, os.environ, file_actions=file_actions)
+
+def _fork_cmd(cmd, output_save_file=None):
+    """
+    start specified command using fork() and execvp(), for platforms
+    without posix_spawnp(), returning its pid
     """
-    if Global.debug:
-        cmd_str = ' '.join(cmd)
-        if output_save_file:
-            cmd_str += ' >& %s' % output_save_file
-        dprint(cmd_str)
     pid = os.fork()
     if pid < 0:
-        print("Error: cannot fork!", flie=sys.stderr)
+        print("Error: cannot fork!", file=sys.stderr)
         sys.exit(1)
     if pid == 0:
         # the child
@@ -94,8 +126,26 @@ def run_cmd(cmd, output_save_file=None):
         os.execvp(cmd[0], cmd)
         # not reached
         sys.exit(1)
+    return pid
+
+def run_cmd(cmd, output_save_file=None):
+    """
+    run specified command, waiting for and returning result
+    """
+    if Global.debug:
+        cmd_str = ' '.join(cmd)
+        if output_save_file:
+            cmd_str += ' >& %s' % output_save_file
+        dprint(cmd_str)
+    if hasattr(os, 'posix_spawnp'):
+        try:
+            pid = _spawn_cmd(cmd, output_save_file)
+        except OSError as e:
+            print('Error: cannot run %s: %s' % (cmd[0], e.strerror), file=sys.stderr)
+            return 127
+    else:
+        pid = _fork_cmd(cmd, output_save_file)
 
-    # the parent
     wpid, wstat = os.waitpid(pid, 0)
     if wstat != 0:
         dprint("exit status: (%d) %d" % (wstat, os.WEXITSTATUS(wstat)))
@@ -237,26 +287,72 @@ def setup_testProgram_overrides(version_str, name):
     unittest.TestProgram.parseArgs = new_parseArgs
     parent_version = version_str
     prog_name = name
+    _init_globals()
+
+@functools.lru_cache(maxsize=None)
+def _which_cached(cmd):
+    """
+    Find a command in our path, remembering the answer
+    """
+    return shutil.which(cmd)
 
 def verify_needed_commands_exist(cmd_list):
     """
     Verify that the commands in the supplied list are in our path
     """
-    path_list = os.getenv('PATH').split(':')
-    any_cmd_not_found = False
-    for cmd in cmd_list:
-        found = False
-        for a_path in path_list:
-            if os.path.exists('%s/%s' % (a_path, cmd)):
-                found = True
-                break
-        if not found:
-            print('Error: %s must be in your PATH' % cmd)
-            any_cmd_not_found = True
-    if any_cmd_not_found:
+    missing = [cmd for cmd in cmd_list if _which_cached(cmd) is None]
+    if missing:
+        print('Error: %s must be in your PATH' % ', '.join(missing))
         sys.exit(1)
 
 
+def _fio_bs_bytes(bs):
+    """
+    Return a fio block size in bytes, or None if we cannot parse it,
+    e.g. for ranges like "4k-64k"
+    """
+    multipliers = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    res = re.match(r'(\d+)([kmg]?)(i?b)?$', bs, re.IGNORECASE)
+    if not res:
+        return None
+    return int(res.group(1)) * multipliers[res.group(2).lower()]
+
+def _fio_direct(bs):
+    """
+    libaio only does asynchronous IO when direct, and direct IO only
+    works with sector-aligned block sizes, so leave the others buffered
+    -- as well as any we cannot parse
+    """
+    size = _fio_bs_bytes(bs)
+    if size is None:
+        dprint('Cannot parse block size %s, not using direct IO' % bs)
+        return 0
+    if size % 512 == 0:
+        return 1
+    return 0
+
+def _device_size(path):
+    """
+    Return the size of a device (or file) in bytes
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+def _fio_failed_jobs(output):
+    """
+    Return the names of the jobs that got an error, from fio JSON output
+    -- skipping any messages fio printed ahead of the JSON
+    """
+    try:
+        results = json.loads(output[output.find('{'):])
+    except ValueError:
+        dprint('Cannot parse fio output: %s' % output)
+        return []
+    return sorted({job['jobname'] for job in results.get('jobs', []) if job.get('error')})
+
 def run_fio():
     """
     Run the fio benchmark for various block sizes.
@@ -273,41 +369,114 @@ def run_fio():
         dprint('NO Global block size pass in?')
         blocksizes = ['512', '1k', '2k', '4k', '8k',
                 '16k', '32k', '75536', '128k', '1000000']
-    # for each block size, do a read test, then a write test
+    # each write-verify thread gets its own slice of the partition (past
+    # the 256k offset), small enough to always be written then verified,
+    # but holding at least one block, in whole blocks
+    try:
+        part_size = _device_size(Global.partition)
+    except OSError as e:
+        return (1, '%s: cannot get size: %s' % (Global.partition, e.strerror))
+    avail_size = part_size - 256 * 1024
+    max_slice_size = min(8 * 1024 * 1024, avail_size // 8)
+    slice_sizes = {}
     for bs in blocksizes:
-        vprint('Running "fio" read/write/verify tests with 8/8/1 threads, bs=%s' % bs)
-        # only support direct IO with aligned reads
-        if bs.endswith('k'):
-            direct=1
-        else:
-            direct=0
+        bs_bytes = _fio_bs_bytes(bs) or 512
+        slice_sizes[bs] = max(bs_bytes, max_slice_size // bs_bytes * bs_bytes)
+        if 8 * slice_sizes[bs] > avail_size:
+            return (1, '%s: partition too small for 8 fio threads with bs=%s (%d bytes)' % \
+                    (Global.partition, bs, part_size))
+    # put all the tests in one job file, so fio only has to start once
+    with tempfile.NamedTemporaryFile(mode='w', prefix='fio-', suffix='.job') as jobfile, \
+         tempfile.NamedTemporaryFile(mode='r', prefix='fio-', suffix='.json') as outfile:
+        jobfile.write('[global]\n')
+        jobfile.write('filename=%s\n' % Global.partition)
+        jobfile.write('ioengine=libaio\n')
+        jobfile.write('iodepth=32\n')
+        jobfile.write('offset=256k\n')
+        # work out the options for each block size just once
+        bs_options = [(bs, 'blocksize=%s\ndirect=%d\n' % (bs, _fio_direct(bs)))
+                      for bs in blocksizes]
+        # the read tests do not change the disc, so they all run at once
+        for (bs, options) in bs_options:
+            jobfile.write('[read-%s]\n' % bs)
+            jobfile.write('runtime=2s\n')
+            jobfile.write('time_based\n')
+            jobfile.write('readwrite=randread\n')
+            jobfile.write('numjobs=8\n')
+            jobfile.write(options)
+        # the write tests share the disc, so "stonewall" them -- they have
+        # no runtime limit, since fio skips the verify pass of a job that
+        # runs out of time, so they are limited by size instead
+        for (bs, options) in bs_options:
+            jobfile.write('[write-verify-%s]\n' % bs)
+            jobfile.write('stonewall\n')
+            jobfile.write('readwrite=randwrite\n')
+            jobfile.write('numjobs=8\n')
+            jobfile.write('size=%d\n' % slice_sizes[bs])
+            jobfile.write('offset_increment=%d\n' % slice_sizes[bs])
+            jobfile.write(options)
+            jobfile.write('verify=md5\n')
+            jobfile.write('do_verify=1\n')
+            jobfile.write('verify_state_save=0\n')
+        jobfile.flush()
+        vprint('Running "fio" read/write+verify tests with 8/8 threads, bs=%s' % \
+               ' '.join(blocksizes))
         ts = time.perf_counter()
-        res = run_cmd(['fio', '--name=read-test', '--readwrite=randread',
-            '--runtime=2s', '--numjobs=8', '--blocksize=%s' % bs, 
-            '--offset=256k',
-            '--direct=%d' % direct, '--filename=%s' % Global.partition])
-        if res != 0:
-            return (res, 'fio failed')
-        res = run_cmd(['fio', '--name=write-test', '--readwrite=randwrite',
-            '--runtime=2s', '--numjobs=8', '--blocksize=%s' % bs, 
-            '--offset=256k',
-            '--direct=%d' % direct, '--filename=%s' % Global.partition])
-        if res != 0:
-            return (res, 'fio failed')
-        res = run_cmd(['fio', '--name=verify-test', '--readwrite=randwrite',
-            '--runtime=2s', '--numjobs=1', '--blocksize=%s' % bs, 
-            '--direct=%d' % direct, '--filename=%s' % Global.partition,
-            '--offset=256k',
-            '--verify=md5', '--verify_state_save=0'])
-        if res != 0:
-            return (res, 'fio failed')
+        res = run_cmd(['fio', '--output-format=json', '--output=%s' % outfile.name,
+                       jobfile.name])
         te = time.perf_counter()
-        Global.timing['fio'] += te - ts
+        output = outfile.read()
+        failed_jobs = _fio_failed_jobs(output)
+        # the output file goes away, so show the errors in it now
+        if res != 0 or failed_jobs:
+            print(output, file=sys.stderr)
+        else:
+            dprint('fio output:\n%s' % output)
+    if res != 0 or failed_jobs:
+        if failed_jobs:
+            return (res or 1, 'fio failed: %s' % ', '.join(failed_jobs))
+        return (res, 'fio failed')
+    Global.timing['fio'] += te - ts
     return (0, 'Success')
 
+def _wait_for_path_inotify(path, present, amt):
+    """
+    Wait until a path exists or is gone, waking up as soon as udev
+    changes the parent directory -- raises OSError if the parent
+    directory cannot be watched
+    """
+    inot = INotify()
+    try:
+        inot.add_watch(os.path.dirname(path),
+                       flags.CREATE | flags.DELETE | flags.MOVED_TO | flags.MOVED_FROM)
+        ts = time.perf_counter()
+        deadline = time.monotonic() + amt
+        try:
+            while os.path.exists(path) != present:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                inot.read(timeout=int(remaining * 1000))
+            return True
+        finally:
+            te = time.perf_counter()
+            Global.timing['sleep'] += te - ts
+    finally:
+        inot.close()
+
 def wait_for_path(path, present=True, amt=10):
     """Wait until a path exists or is gone"""
     dprint("Looking for path=%s, present=%s" % (path, present))
+    if INotify is not None:
+        try:
+            if _wait_for_path_inotify(path, present, amt):
+                dprint("We are Happy :) present=%s" % present)
+                return True
+            dprint("We are not happy :( present=%s actual=%s after %d seconds" % \
+                   (present, os.path.exists(path), amt))
+            return False
+        except OSError as e:
+            dprint("Cannot watch for path=%s (%s), polling instead" % (path, e))
     for i in range(amt):
         sleep_some(1)
         if os.path.exists(path) == present:
@@ -319,13 +488,12 @@ def wait_for_path(path, present=True, amt=10):
 
 def wipe_disc():
     """
-    Wipe the label and partition table from the disc drive -- the sleep-s
-    are needed to give the async OS and udev a chance to notice the partition
-    table has been erased
+    Wipe the label and partition table from the disc drive -- the caller
+    has to wait for the async OS and udev to notice the partition table
+    has been erased
     """
     # zero out the label and parition table
     vprint('Running "sgdisk" and "dd" to wipe disc label, partitions, and filesystem')
-    sleep_some(1)
     ts = time.perf_counter()
     res = run_cmd(['sgdisk', '--clear', Global.device])
     te = time.perf_counter()
@@ -340,6 +508,13 @@ def wipe_disc():
             return (res, '%s: could not zero out label after two tries: %d' % \
                     (Global.device, res))
         Global.timing['sgdisk'] += te - ts
+    return wipe_filesystem()
+
+def wipe_filesystem():
+    """
+    Zero out the start of the disc drive, so that no old filesystem
+    is found there
+    """
     ts = time.perf_counter()
     res = run_cmd(['dd', 'if=/dev/zero', 'of=%s' % Global.device, 'bs=256k', 'count=20', 'oflag=direct'])
     te = time.perf_counter()
@@ -358,6 +533,8 @@ def run_parted():
 
     Uses Globals: device, partition
     """
+    if parted is not None:
+        return _run_libparted()
     (res, reason) = wipe_disc()
     if res != 0:
         return (res, reason)
@@ -378,6 +555,53 @@ def run_parted():
     # success
     return (0, 'Success')
 
+def _run_libparted():
+    """
+    Same as run_parted(), but using the libparted python bindings instead
+    of running sgdisk and parted -- note that pyparted exceptions do not
+    have a common base class
+    """
+    vprint('Using libparted and running "dd" to wipe disc label, partitions, and filesystem')
+    ts = time.perf_counter()
+    try:
+        dev = parted.getDevice(Global.device)
+        dev.clobber()
+        # clobber() does not tell the kernel, but committing an empty
+        # label does, so that our old partition goes away
+        parted.freshDisk(dev, 'gpt').commit()
+    except Exception as e:
+        return (1, '%s: could not zero out label: %s' % (Global.device, e))
+    te = time.perf_counter()
+    Global.timing['libparted'] += te - ts
+    (res, reason) = wipe_filesystem()
+    if res != 0:
+        return (res, reason)
+    # ensure our partition file is not there, to be safe
+    if not wait_for_path(Global.partition, present=False, amt=30):
+        return (1, '%s: Partition already exists?' % Global.partition)
+    # make a label, then a partition table with one partition
+    vprint('Using libparted to create a label and partition table')
+    ts = time.perf_counter()
+    try:
+        disk = parted.freshDisk(dev, 'gpt')
+    except Exception as e:
+        return (1, '%s: Could not create a GPT label: %s' % (Global.device, e))
+    try:
+        # like "parted -a none ... 0 100%", use all of the free space
+        geom = disk.getFreeSpaceRegions()[0]
+        part = parted.Partition(disk=disk, type=parted.PARTITION_NORMAL, geometry=geom)
+        disk.addPartition(partition=part, constraint=parted.Constraint(exactGeom=geom))
+        disk.commit()
+    except Exception as e:
+        return (1, '%s: Could not create a primary partition: %s' % (Global.device, e))
+    te = time.perf_counter()
+    Global.timing['libparted'] += te - ts
+    # wait for the partition to show up
+    if not wait_for_path(Global.partition):
+        return (1, '%s: Partition never showed up?' % Global.partition)
+    # success
+    return (0, 'Success')
+
 def run_mkfs():
     vprint('Running "mkfs" to to create filesystem')
     ts = time.perf_counter()
@@ -389,25 +613,32 @@ def run_mkfs():
     return (0, 'Success')
 
 def run_bonnie():
-    # make a temp dir and mount the device there
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        vprint('Running "mount" to mount the filesystem')
-        res = run_cmd(['mount'] + Global.MOUNTOPTIONS + [Global.partition, tmp_dir])
-        if res != 0:
-            return (res, '%s: mount failed (%d)' % (Global.partition, res))
-        # run bonnie++ on the new directory
+    """
+    Mount the filesystem, run bonnie++ on it, then unmount it
+
+    Uses Globals: partition, mountpoint
+    """
+    # the mount point is made once for the whole test run, since the
+    # filesystem is remade (and the device logged out) between subtests
+    vprint('Running "mount" to mount the filesystem')
+    res = run_cmd(['mount'] + Global.MOUNTOPTIONS + [Global.partition, Global.mountpoint])
+    if res != 0:
+        return (res, '%s: mount failed (%d)' % (Global.partition, res))
+    # run bonnie++ on the mounted filesystem -- always unmounting after,
+    # so the shared mount point is not left mounted if it fails
+    try:
         vprint('Running "bonnie++" on the filesystem')
         ts = time.perf_counter()
-        res = run_cmd(['bonnie++'] + Global.BONNIEPARAMS + ['-d', tmp_dir])
+        res = run_cmd(['bonnie++'] + Global.BONNIEPARAMS + ['-d', Global.mountpoint])
         te = time.perf_counter()
-        if res != 0:
-            return (res, '%s: umount failed (%d)' % (tmp_dir, res))
-        Global.timing['bonnie'] += te - ts
-        # unmount the device and remove the temp dir
+    finally:
         vprint('Running "umount" to unmount the filesystem')
-        res = run_cmd(['umount', tmp_dir])
-        if res != 0:
-            return (res, '%s: umount failed (%d)' % (tmp_dir, res))
+        umount_res = run_cmd(['umount', Global.mountpoint])
+    if res != 0:
+        return (res, '%s: bonnie++ failed (%d)' % (Global.mountpoint, res))
+    Global.timing['bonnie'] += te - ts
+    if umount_res != 0:
+        return (umount_res, '%s: umount failed (%d)' % (Global.mountpoint, umount_res))
     return (0, 'Success')
 
 def sleep_some(s):